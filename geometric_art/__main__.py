@@ -1,33 +1,46 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 import os
+from queue import Empty, Queue
 import shutil
+from threading import Thread
 import time
 
+from matplotlib.animation import FuncAnimation
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 
+from .evaluation import evaluate, init_evaluation
 from .shapes import CirclePopulation, PolygonPopulation
-from .renderer import CircleRenderer, PolygonRenderer
-from .utils import compute_similarity, get_time_elapsed
+from .renderer import CircleRenderer, LayerCache, PolygonRenderer
+from .utils import compute_similarity, get_region, get_time_elapsed
 
 
 # Get arguments
 parser = argparse.ArgumentParser(description="Hill-climbing optimization to represent images using geometric shapes.")
 parser.add_argument("image", help="Path to the image to represent")
+parser.add_argument("-b", "--backend", help="Library used to render the shapes (numpy only draws circles, polygons use pil)", choices=["pil", "numpy", "numba"], default="pil")
 parser.add_argument("-c", "--circle", help="Uses circles instead of polygons", action="store_true")
+parser.add_argument("-g", "--gaussian", help="Perturbs the shapes with adaptive Gaussian steps instead of resampling them", action="store_true")
 parser.add_argument("-i", "--iterations", help="Number of iterations", type=int, default=100000)
 parser.add_argument("-m", "--maxradius", help="Specifies the maximum radius of circles", type=int, default=30)
 parser.add_argument("-n", "--number", help="Number of geometric shapes", type=int, default=50)
+parser.add_argument("-o", "--opaque", help="Uses opaque shapes instead of semitransparent ones", action="store_true")
 parser.add_argument("-p", "--plot", help="Plots best image until current generation", action="store_true")
 parser.add_argument("-r", "--random", help="Random seed for the number generation", type=int)
 parser.add_argument("-s", "--sides", help="Number of sides for the polygons", type=int, default=6)
+parser.add_argument("-t", "--threads", help="Evaluates changes in threads instead of processes (needs -w above 1)", action="store_true")
 parser.add_argument("-v", "--verbose", help="Prints current iteration, number of changes and similarity", action="store_true")
+parser.add_argument("-w", "--workers", help="Number of workers evaluating changes in parallel", type=int, default=1)
+parser.add_argument("-z", "--sort", help="Keeps larger shapes below smaller ones", action="store_true")
 args = parser.parse_args()
+if args.workers < 1:
+    parser.error("argument -w/--workers: must be at least 1")
 
 # Random seed for reproducibility
-if args.random:
-    np.random.seed(args.random)
+rng = np.random.default_rng(args.random)
 
 # Directory path
 path = os.getcwd()
@@ -41,6 +54,12 @@ max_radius = args.maxradius
 image = args.image
 verbose = args.verbose
 plot = args.plot
+opaque = args.opaque
+sort = args.sort
+gaussian = args.gaussian
+num_workers = args.workers
+threads = args.threads
+backend = args.backend
 directory = path
 
 # Create folders to store temporal and generated images
@@ -56,30 +75,62 @@ target = Image.open(image).convert('RGB')
 target.save(f'{directory}/run/target.png')
 size = target.size
 
+# NumPy only renders circles, and Numba is an optional dependency
+if backend == "numpy":
+    from .renderer import NumpyCircleRenderer as CircleRenderer
+elif backend == "numba":
+    from .numba_renderer import NumbaCircleRenderer as CircleRenderer, NumbaPolygonRenderer as PolygonRenderer
+
 # Define functions according to shape
 if is_circle:
-    shape_population = CirclePopulation(num_individuals, size, max_radius)
-    renderer = CircleRenderer(size)
+    shape_population = CirclePopulation(num_individuals, size, max_radius, rng, opaque, sort, gaussian)
+    renderer = CircleRenderer(size, opaque)
 else:
-    shape_population = PolygonPopulation(num_individuals, size, num_sides)
-    renderer = PolygonRenderer(size)
+    shape_population = PolygonPopulation(num_individuals, size, num_sides, rng, opaque, sort, gaussian)
+    renderer = PolygonRenderer(size, opaque)
+
+# Target pixels, converted once, and scratch buffer for the differences
+target_np = np.ascontiguousarray(np.asarray(target, dtype=np.uint8))
+difference_buffer = np.empty_like(target_np, dtype=np.int16)
 
 # Initial image
-max_difference = np.prod(np.array(target).shape) * 255
-image = renderer.render(shape_population.individuals)
-similarity = compute_similarity(target, image, max_difference)
+max_difference = target_np.size * 255
+image = np.array(renderer.render(shape_population.individuals))
+difference = renderer.compare(target_np, image, difference_buffer)
+similarity = compute_similarity(difference, max_difference)
+
+# Cache the canvas every few individuals, so changes only redraw the individuals above
+layer_stride = 8
+layers = LayerCache(renderer, shape_population.individuals, layer_stride)
+
+# Compile the scoring kernel before the loop, with the read-only target the evaluation uses
+if backend == "numba":
+    warm_up_target = target_np.view()
+    warm_up_target.flags.writeable = False
+    renderer.score(shape_population.individuals[:1], warm_up_target, (0, 0, 1, 1), difference_buffer)
+
+# Evaluate one change per worker in each step, with threads sharing the population without copies
+if num_workers > 1:
+    Executor = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    executor = Executor(num_workers, initializer=init_evaluation, initargs=(target_np.tobytes(), size, renderer))
+    evaluate_changes = executor.map
+else:
+    evaluate_changes = map
 
 # Main loop
 iteration = 0
 changes = 0
-print_iteration = 10000
-plot_iteration = 100
+# Powers of two, so the checks in the loop are bit masks
+print_iteration = 8192
+plot_iteration = 128
+plot_interval = 100
+title_frames = 10
+title = time_text = None
 
 if plot:
-    # plt.ion()
     fig = plt.figure(figsize=(6, 3))
     ax1 = fig.add_subplot(121)
-    ax1.imshow(target)
+    ax1.imshow(target_np)
     plt.axis('off')
     ax2 = fig.add_subplot(122)
     updated_image = ax2.imshow(image)
@@ -89,25 +140,127 @@ if plot:
     text = plt.text(0, 285, f'Time: 10:00:00', fontsize=12, horizontalalignment='center')
     start = time.time()
 
-while iteration <= num_iterations:
-    new_individuals = shape_population.change()
-    new_image = renderer.render(new_individuals)
-    new_similarity = compute_similarity(target, new_image, max_difference)
-    if new_similarity > similarity:
-        similarity = new_similarity
-        shape_population.individuals = new_individuals
-        image = new_image
-        changes += 1
-    if iteration % print_iteration == 0 and verbose:
-        image.save(f'{directory}/run/output_{iteration}.png')
-        print(f"Iterations: {iteration}  Changes: {changes}  Similarity: {similarity:.02f}%")
-    if iteration % plot_iteration == 0 and plot:
-        updated_image.set_data(image)
-        plt.suptitle(f"Iterations: {iteration}  Changes: {changes}  Similarity: {similarity:.02f}%")
-        hours, minutes, seconds = get_time_elapsed(start)
-        text.set_text(f'Time: {hours:02d}:{minutes:02d}:{seconds:02d}')
-        plt.draw()
-        plt.pause(0.00001)
-    iteration += 1
-plt.show()
-image.save(f'{directory}/output/{similarity:.02f}_{num_individuals}_{num_sides}_{target_name}')
+
+def send_frame(frames):
+    """
+    Replaces the frame waiting to be plotted with the current state, so the plot never falls behind.
+
+    Args:
+        frames (queue.Queue): Queue holding at most one frame.
+    """
+    try:
+        frames.get_nowait()
+    except Empty:
+        pass
+    frames.put((iteration, changes, similarity, get_time_elapsed(start), image.copy()))
+
+
+def optimize(frames=None):
+    """
+    Runs the hill climbing, sending the current image to the plot every few iterations.
+
+    Args:
+        frames (queue.Queue): Queue of frames to plot. Defaults to None when not plotting.
+    """
+    global iteration, changes, difference, similarity
+    # Without workers, changes are evaluated in the thread running the optimization
+    if num_workers == 1:
+        init_evaluation(target_np.tobytes(), size, renderer)
+    while iteration <= num_iterations:
+        proposals = []
+        for _ in range(num_workers):
+            proposal = shape_population.propose()
+            # Changes that cannot modify the image are rejected without rendering
+            if shape_population.modifies_image(*proposal[:3]):
+                proposals.append(proposal)
+            else:
+                shape_population.record(proposal[1], False)
+        if proposals:
+            # Only the region covered by the changed individual (before and after) can differ
+            boxes = [shape_population.change_box(*proposal[:3]) for proposal in proposals]
+            firsts, backgrounds = zip(*[layers.start(min(proposal[0], proposal[3]), box) for proposal, box in zip(proposals, boxes)])
+            results = list(evaluate_changes(evaluate, repeat(shape_population.individuals),
+                                            repeat(shape_population.bounding_boxes), proposals, boxes, firsts, backgrounds))
+            deltas = [new_difference - renderer.compare(get_region(target_np, box), get_region(image, box), difference_buffer)
+                      for (new_difference, _), box in zip(results, boxes)]
+            best = int(np.argmin(deltas))
+            for k, proposal in enumerate(proposals):
+                shape_population.record(proposal[1], k == best and deltas[best] < 0)
+            if deltas[best] < 0:
+                difference += deltas[best]
+                similarity = compute_similarity(difference, max_difference)
+                shape_population.apply(*proposals[best])
+                layers.update(shape_population.individuals, shape_population.bounding_boxes,
+                              proposals[best][0], boxes[best], proposals[best][3])
+                get_region(image, boxes[best])[:] = results[best][1]
+                changes += 1
+        if iteration & (print_iteration - 1) < num_workers and verbose:
+            Image.fromarray(image).save(f'{directory}/run/output_{iteration}.png')
+            print(f"Iterations: {iteration}  Changes: {changes}  Similarity: {similarity:.02f}%")
+        if iteration & (plot_iteration - 1) < num_workers and plot:
+            send_frame(frames)
+        iteration += num_workers
+    # The last state is plotted too, matching the saved image
+    if plot:
+        send_frame(frames)
+
+
+def update_plot(frame_number):
+    """
+    Plots the latest frame sent by the optimization, if any, blitting only the image.
+
+    Args:
+        frame_number (int): Number of times the plot has been updated.
+
+    Returns:
+        tuple: Artists redrawn.
+    """
+    global title, time_text
+    try:
+        frame_iteration, frame_changes, frame_similarity, (hours, minutes, seconds), frame_image = frames.get_nowait()
+        updated_image.set_data(frame_image)
+        title = f"Iterations: {frame_iteration}  Changes: {frame_changes}  Similarity: {frame_similarity:.02f}%"
+        time_text = f'Time: {hours:02d}:{minutes:02d}:{seconds:02d}'
+    except Empty:
+        pass
+    # The texts lie outside the image, so they are refreshed with a full redraw only every few updates,
+    # drawn right away so the image is blitted back over it before the window repaints
+    if frame_number % title_frames == 0 and title is not None:
+        plt.suptitle(title)
+        text.set_text(time_text)
+        fig.canvas.draw()
+        title = None
+    return updated_image,
+
+
+def optimize_in_background(frames, errors):
+    """
+    Runs the optimization in a background thread, keeping its exception to raise it in the main thread.
+
+    Args:
+        frames (queue.Queue): Queue of frames to plot.
+        errors (list): Exceptions raised by the optimization.
+    """
+    try:
+        optimize(frames)
+    except Exception as error:
+        errors.append(error)
+
+
+if plot:
+    # Optimize in the background while the plot refreshes on its own schedule
+    frames = Queue(maxsize=1)
+    errors = []
+    optimizer = Thread(target=optimize_in_background, args=(frames, errors), daemon=True)
+    optimizer.start()
+    animation = FuncAnimation(fig, update_plot, interval=plot_interval, save_count=1, blit=True)
+    plt.show()
+    optimizer.join()
+    # A failed optimization stops the run instead of saving an unfinished image
+    if errors:
+        raise errors[0]
+else:
+    optimize()
+if num_workers > 1:
+    executor.shutdown()
+Image.fromarray(image).save(f'{directory}/output/{similarity:.02f}_{num_individuals}_{num_sides}_{target_name}')
@@ -0,0 +1,57 @@
+from copy import deepcopy
+import threading
+
+import numpy as np
+
+from .utils import move, overlaps
+
+
+# State of the evaluation, set once per process or thread
+_state = threading.local()
+
+
+def init_evaluation(target_bytes, size, renderer):
+    """
+    Prepares the process or thread to evaluate candidate populations.
+
+    Args:
+        target_bytes (bytes): Raw RGB pixels of the objective image.
+        size (tuple): Target image dimensions.
+        renderer (Renderer): Renderer of the populations, copied so that each thread draws on its own canvas.
+    """
+    _state.target = np.frombuffer(target_bytes, dtype=np.uint8).reshape(size[1], size[0], 3)
+    _state.renderer = deepcopy(renderer)
+    _state.difference_buffer = np.empty(_state.target.shape, dtype=np.int16)
+
+
+def evaluate(individuals, bounding_boxes, change, box, first, background):
+    """
+    Computes the difference between the population after a change and the target inside a region.
+
+    Only the individuals from the first one given that overlap the region are drawn on the background.
+
+    Args:
+        individuals (np.array): Array of individuals.
+        bounding_boxes (np.array): Region covered by each individual.
+        change (tuple): Index of the individual, position, new value and new index of the individual.
+        box (tuple): Region (left, upper, right, lower) to compare.
+        first (int): Index of the first individual to draw, not above the old and new index of the individual.
+        background (np.array): Pixels of the region after drawing the individuals before the first one.
+
+    Returns:
+        tuple: Sum of the absolute pixel differences inside the region and the rendered region.
+    """
+    index, position, value, slot = change
+    visible = overlaps(bounding_boxes, box)
+    visible[index] = True
+    # Without individuals below overlapping the region, the background is plain white
+    if not visible[:first].any():
+        first, background = 0, None
+    candidates = individuals[first:][visible[first:]]
+    row = np.count_nonzero(visible[first:index])
+    candidates[row, position] = value
+    if slot != index:
+        # The individual moves past the visible individuals between its index and its slot
+        move(candidates, row, np.count_nonzero(visible[first:slot + 1]) - 1 if slot > index
+             else np.count_nonzero(visible[first:slot]))
+    return _state.renderer.score(candidates, _state.target, box, _state.difference_buffer, background)
@@ -0,0 +1,235 @@
+import numpy as np
+from numba import njit
+
+from .renderer import Renderer
+from .utils import get_region
+
+
+@njit(cache=True, inline='always')
+def blend_span(canvas, y, x_start, x_end, rgba):
+    """ Blends a color into a horizontal span of the canvas, rounding as Pillow does. """
+    row = canvas[y]
+    if rgba.shape[0] == 3:
+        for x in range(x_start, x_end):
+            row[x, 0], row[x, 1], row[x, 2] = rgba[0], rgba[1], rgba[2]
+        return
+    alpha = rgba[3]
+    inverse_alpha = 255 - alpha
+    red, green, blue = rgba[0] * alpha + 128, rgba[1] * alpha + 128, rgba[2] * alpha + 128
+    for x in range(x_start, x_end):
+        value = red + row[x, 0] * inverse_alpha
+        row[x, 0] = (value + (value >> 8)) >> 8
+        value = green + row[x, 1] * inverse_alpha
+        row[x, 1] = (value + (value >> 8)) >> 8
+        value = blue + row[x, 2] * inverse_alpha
+        row[x, 2] = (value + (value >> 8)) >> 8
+
+
+@njit(cache=True)
+def rasterize_polygon(canvas, xs, ys, rgba, box):
+    """
+    Fills a polygon inside a region of the canvas using scanlines.
+
+    Args:
+        canvas (np.array): Image as an array of rows.
+        xs (np.array): Horizontal coordinates of the vertices.
+        ys (np.array): Vertical coordinates of the vertices.
+        rgba (np.array): Color and transparency of the polygon.
+        box (tuple): Region (left, upper, right, lower) to draw.
+    """
+    left, upper, right, lower = box
+    num_vertices = xs.shape[0]
+    crossings = np.empty(num_vertices)
+    for y in range(max(int(ys.min()), upper), min(int(ys.max()) + 1, lower)):
+        # Crossings of the edges with the scanline in increasing order, filled with the even-odd rule
+        count = 0
+        for i in range(num_vertices):
+            j = i + 1 if i + 1 < num_vertices else 0
+            if (ys[i] <= y < ys[j]) or (ys[j] <= y < ys[i]):
+                crossing = xs[i] + (y - ys[i]) * (xs[j] - xs[i]) / (ys[j] - ys[i])
+                k = count
+                while k > 0 and crossings[k - 1] > crossing:
+                    crossings[k] = crossings[k - 1]
+                    k -= 1
+                crossings[k] = crossing
+                count += 1
+        for k in range(0, count - 1, 2):
+            blend_span(canvas, y, max(int(np.ceil(crossings[k])), left),
+                       min(int(np.floor(crossings[k + 1])) + 1, right), rgba)
+
+
+@njit(cache=True)
+def rasterize_circle(canvas, cx, cy, radius, rgba, box):
+    """
+    Fills a circle inside a region of the canvas using horizontal spans.
+
+    Args:
+        canvas (np.array): Image as an array of rows.
+        cx (int): Horizontal coordinate of the center.
+        cy (int): Vertical coordinate of the center.
+        radius (int): Radius of the circle.
+        rgba (np.array): Color and transparency of the circle.
+        box (tuple): Region (left, upper, right, lower) to draw.
+    """
+    left, upper, right, lower = box
+    for y in range(max(cy - radius, upper), min(cy + radius + 1, lower)):
+        half_width = int(np.sqrt(radius * radius - (y - cy) * (y - cy)))
+        blend_span(canvas, y, max(cx - half_width, left), min(cx + half_width + 1, right), rgba)
+
+
+@njit(cache=True, inline='always')
+def difference_span(target_row, output_row):
+    """ Sums the absolute differences between two rows of bytes, a loop the compiler vectorizes. """
+    difference = 0
+    for i in range(target_row.shape[0]):
+        difference += abs(np.int32(target_row[i]) - np.int32(output_row[i]))
+    return difference
+
+
+@njit(cache=True, nogil=True)
+def difference_rows(target, output):
+    """
+    Sums the absolute differences between two images given as arrays of rows.
+
+    Args:
+        target (np.array): Objective image with the channels of each row flattened.
+        output (np.array): Generated image with the channels of each row flattened.
+
+    Returns:
+        int: Sum of the absolute pixel differences.
+    """
+    difference = 0
+    for y in range(target.shape[0]):
+        difference += difference_span(target[y], output[y])
+    return difference
+
+
+@njit(cache=True, nogil=True)
+def render_region(individuals, canvas, box, circles, num_channels):
+    """
+    Renders a population on top of a region of the canvas.
+
+    Args:
+        individuals (np.array): Array of individuals.
+        canvas (np.array): Image as an array of rows.
+        box (tuple): Region (left, upper, right, lower) to render.
+        circles (bool): Whether the individuals are circles or polygons.
+        num_channels (int): Number of color channels of each individual.
+    """
+    for individual in individuals:
+        rgba = individual[-num_channels:]
+        if circles:
+            rasterize_circle(canvas, individual[0], individual[1], individual[2], rgba, box)
+        else:
+            rasterize_polygon(canvas, individual[:-num_channels:2], individual[1:-num_channels:2], rgba, box)
+
+
+@njit(cache=True, nogil=True)
+def render_and_score(individuals, canvas, target, box, circles, num_channels):
+    """
+    Renders a population on top of a region of the canvas and compares it with the target.
+
+    Args:
+        individuals (np.array): Array of individuals.
+        canvas (np.array): Image as an array of rows.
+        target (np.array): Objective image.
+        box (tuple): Region (left, upper, right, lower) to render.
+        circles (bool): Whether the individuals are circles or polygons.
+        num_channels (int): Number of color channels of each individual.
+
+    Returns:
+        int: Sum of the absolute pixel differences inside the region.
+    """
+    left, upper, right, lower = box
+    render_region(individuals, canvas, box, circles, num_channels)
+    difference = 0
+    for y in range(upper, lower):
+        difference += difference_span(target[y].reshape(-1)[3 * left:3 * right], canvas[y].reshape(-1)[3 * left:3 * right])
+    return difference
+
+
+class NumbaRenderer(Renderer):
+    """ Renderer compiled with Numba that draws on a persistent canvas. """
+    circles = False
+
+    def __init__(self, size, opaque=False):
+        """
+        Initializes a compiled renderer.
+
+        Args:
+            size (tuple): Target image dimensions.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
+        """
+        self.size = size
+        self.num_channels = 3 if opaque else 4
+        self.canvas = np.full((size[1], size[0], 3), 255, dtype=np.uint8)
+
+    def _get_box(self, box):
+        """ Region to render as a tuple of integers. """
+        if box is None:
+            return (0, 0) + tuple(self.size)
+        return tuple(int(value) for value in box)
+
+    def _clear(self, box, background):
+        """ Fills a region of the canvas with the background, or white if not given. """
+        get_region(self.canvas, box)[:] = background if background is not None else 255
+
+    def compare(self, target, output, buffer):
+        """
+        Compares two images in a single compiled pass.
+
+        Args:
+            target (np.array): Objective image.
+            output (np.array): Generated image.
+            buffer (np.array): Unused, kept for compatibility with other renderers.
+
+        Returns:
+            int: Sum of the absolute pixel differences.
+        """
+        return difference_rows(target.reshape(target.shape[0], -1), output.reshape(output.shape[0], -1))
+
+    def render(self, individuals, box=None, background=None):
+        """
+        Renders a population.
+
+        Args:
+            individuals (np.array): Array of individuals.
+            box (tuple): Region (left, upper, right, lower) to render. Defaults to the whole image.
+            background (np.array): Pixels of the region to draw on. Defaults to white.
+
+        Returns:
+            np.array: Image representation of the population inside the region.
+        """
+        box = self._get_box(box)
+        self._clear(box, background)
+        render_region(individuals, self.canvas, box, self.circles, self.num_channels)
+        return get_region(self.canvas, box).copy()
+
+    def score(self, individuals, target, box, buffer, background=None):
+        """
+        Renders a population inside a region and compares it with the target in a single compiled call.
+
+        Args:
+            individuals (np.array): Array of individuals.
+            target (np.array): Objective image.
+            box (tuple): Region (left, upper, right, lower) to render.
+            buffer (np.array): Unused, kept for compatibility with other renderers.
+            background (np.array): Pixels of the region to draw on. Defaults to white.
+
+        Returns:
+            tuple: Sum of the absolute pixel differences inside the region and the rendered region.
+        """
+        box = self._get_box(box)
+        self._clear(box, background)
+        difference = render_and_score(individuals, self.canvas, target, box, self.circles, self.num_channels)
+        return difference, get_region(self.canvas, box).copy()
+
+
+class NumbaCircleRenderer(NumbaRenderer):
+    """ Compiled renderer of a population of circles. """
+    circles = True
+
+
+class NumbaPolygonRenderer(NumbaRenderer):
+    """ Compiled renderer of a population of polygons. """
+    circles = False
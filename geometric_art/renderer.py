@@ -1,72 +1,250 @@
 from abc import ABC, abstractmethod
 
+import numpy as np
 from PIL import Image, ImageDraw
 
+from .utils import compute_difference, get_region, overlaps
+
 
 class Renderer(ABC):
     """ Renders a population to obtain an image representation. """
     @abstractmethod
-    def render(self, shape_population):
+    def render(self, shape_population, box=None, background=None):
         """ Renders population. """
         pass
 
+    def compare(self, target, output, buffer):
+        """
+        Compares two images.
+
+        Args:
+            target (np.array): Objective image.
+            output (np.array): Generated image.
+            buffer (np.array): Scratch int16 array at least as large as the images.
+
+        Returns:
+            int: Sum of the absolute pixel differences.
+        """
+        return compute_difference(target, output, buffer)
+
+    def score(self, individuals, target, box, buffer, background=None):
+        """
+        Renders a population inside a region and compares it with the target.
+
+        Args:
+            individuals (np.array): Array of individuals.
+            target (np.array): Objective image.
+            box (tuple): Region (left, upper, right, lower) to render.
+            buffer (np.array): Scratch int16 array at least as large as the target.
+            background (np.array): Pixels of the region to draw on. Defaults to white.
+
+        Returns:
+            tuple: Sum of the absolute pixel differences inside the region and the rendered region.
+        """
+        region = np.asarray(self.render(individuals, box, background))
+        return self.compare(get_region(target, box), region, buffer), region
+
 
 class CircleRenderer(Renderer):
     """ Renderer of a population of circles. """
-    def __init__(self, size):
+    def __init__(self, size, opaque=False):
+        """
+        Initializes a renderer for circles.
+
+        Args:
+            size (tuple): Target image dimensions.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
+        """
+        self.size = size
+        self.num_channels = 3 if opaque else 4
+        self.canvas = Image.new('RGB', size, color=(255, 255, 255))
+
+    def render(self, individuals, box=None, background=None):
+        """
+        Renders a population of circles.
+
+        Args:
+            individuals (np.array): Array of individuals.
+            box (tuple): Region (left, upper, right, lower) to render. Defaults to the whole image.
+            background (np.array): Pixels of the region to draw on. Defaults to white.
+
+        Returns:
+            canvas (PIL.Image): Image representation of the population inside the region.
+        """
+        if box is None:
+            box = (0, 0) + tuple(self.size)
+        # Shapes keep their coordinates, so only the region of the canvas is cleared
+        if background is None:
+            self.canvas.paste((255, 255, 255), box)
+        else:
+            self.canvas.paste(Image.fromarray(background), box[:2])
+        draw = ImageDraw.Draw(self.canvas, 'RGBA' if self.num_channels == 4 else 'RGB')
+        # Plain integers, converted once, are cheaper for Pillow than NumPy scalars
+        for x, y, radius, *color in individuals.tolist():
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), tuple(color))
+        return self.canvas.crop(box)
+
+
+class NumpyCircleRenderer(Renderer):
+    """ Renderer of a population of circles that blends their masks with NumPy. """
+    def __init__(self, size, opaque=False):
         """
         Initializes a renderer for circles.
 
         Args:
             size (tuple): Target image dimensions.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
         """
         self.size = size
+        self.num_channels = 3 if opaque else 4
+        self.canvas = np.full((size[1], size[0], 3), 255, dtype=np.uint8)
+        self._disks = {}
+
+    def _disk(self, radius):
+        """
+        Mask of a circle, computed once per radius.
+
+        Args:
+            radius (int): Radius of the circle.
+
+        Returns:
+            np.array: Boolean mask of the pixels covered by the circle inside its box, with one channel.
+        """
+        if radius not in self._disks:
+            offsets = np.arange(-radius, radius + 1) ** 2
+            self._disks[radius] = (offsets[:, None] + offsets <= radius * radius)[:, :, None]
+        return self._disks[radius]
 
-    def render(self, individuals):
+    def render(self, individuals, box=None, background=None):
         """
         Renders a population of circles.
 
         Args:
             individuals (np.array): Array of individuals.
+            box (tuple): Region (left, upper, right, lower) to render. Defaults to the whole image.
+            background (np.array): Pixels of the region to draw on. Defaults to white.
 
         Returns:
-            canvas (PIL.Image): Image representation of the population.
+            np.array: Image representation of the population inside the region.
         """
-        canvas = Image.new('RGB', self.size, color=(255, 255, 255))
-        for individual in individuals:
-            draw = ImageDraw.Draw(canvas, 'RGBA')
-            x, y = tuple(individual[:2].astype(int))
-            radius = individual[2].astype(int)
-            color = tuple(individual[3:].astype(int))
-            draw.ellipse((x - radius, y - radius, x + radius, y + radius), color)
-        return canvas
+        if box is None:
+            box = (0, 0) + tuple(self.size)
+        get_region(self.canvas, box)[:] = background if background is not None else 255
+        for x, y, radius, *color in individuals.tolist():
+            # Only the part of the region covered by the circle is masked
+            left, upper = max(x - radius, box[0]), max(y - radius, box[1])
+            right, lower = min(x + radius + 1, box[2]), min(y + radius + 1, box[3])
+            if left >= right or upper >= lower:
+                continue
+            mask = self._disk(radius)[upper - y + radius:lower - y + radius, left - x + radius:right - x + radius]
+            window = self.canvas[upper:lower, left:right]
+            if self.num_channels == 3:
+                np.copyto(window, color, where=mask, casting='unsafe')
+                continue
+            # Blend the whole window with the same rounding as Pillow, which fits in 16 bits, and keep the disk
+            alpha = color[3]
+            value = np.multiply(window, 255 - alpha, dtype=np.uint16)
+            value += np.array(color[:3], dtype=np.uint16) * alpha + 128
+            value += value >> 8
+            value >>= 8
+            np.copyto(window, value, where=mask, casting='unsafe')
+        return get_region(self.canvas, box).copy()
 
 
 class PolygonRenderer(Renderer):
     """ Renderer of a population of polygons """
-    def __init__(self, size):
+    def __init__(self, size, opaque=False):
         """
         Initializes a renderer for polygons.
 
         Args:
             size (tuple): Target image dimensions.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
         """
         self.size = size
+        self.num_channels = 3 if opaque else 4
+        self.canvas = Image.new('RGB', size, color=(255, 255, 255))
 
-    def render(self, individuals):
+    def render(self, individuals, box=None, background=None):
         """
         Renders a population of polygons.
 
         Args:
             individuals (np.array): Array of individuals.
+            box (tuple): Region (left, upper, right, lower) to render. Defaults to the whole image.
+            background (np.array): Pixels of the region to draw on. Defaults to white.
 
         Returns:
-            canvas (PIL.Image): Image representation of the population.
-        """
-        canvas = Image.new('RGB', self.size, color=(255, 255, 255))
-        for individual in individuals:
-            draw = ImageDraw.Draw(canvas, 'RGBA')
-            points = list(individual[:-4].astype(int))
-            color = tuple(individual[-4:].astype(int))
-            draw.polygon(points, color)
-        return canvas
+            canvas (PIL.Image): Image representation of the population inside the region.
+        """
+        if box is None:
+            box = (0, 0) + tuple(self.size)
+        # Shapes keep their coordinates, so only the region of the canvas is cleared
+        if background is None:
+            self.canvas.paste((255, 255, 255), box)
+        else:
+            self.canvas.paste(Image.fromarray(background), box[:2])
+        draw = ImageDraw.Draw(self.canvas, 'RGBA' if self.num_channels == 4 else 'RGB')
+        # Plain integers, converted once, are cheaper for Pillow than NumPy scalars
+        for individual in individuals.tolist():
+            draw.polygon(individual[:-self.num_channels], tuple(individual[-self.num_channels:]))
+        return self.canvas.crop(box)
+
+
+class LayerCache:
+    """ Canvases of the population drawn up to every few individuals. """
+    def __init__(self, renderer, individuals, stride):
+        """
+        Draws the layers of the initial population.
+
+        Args:
+            renderer (Renderer): Renderer of the population.
+            individuals (np.array): Array of individuals.
+            stride (int): Number of individuals between consecutive layers.
+        """
+        self.renderer = renderer
+        self.stride = stride
+        # Layer k holds the canvas after drawing the first k * stride individuals
+        num_layers = (len(individuals) - 1) // stride + 1
+        self.layers = np.empty((num_layers, renderer.size[1], renderer.size[0], 3), dtype=np.uint8)
+        self.layers[0] = 255
+        for k in range(1, num_layers):
+            self.layers[k] = self.renderer.render(individuals[(k - 1) * stride:k * stride], background=self.layers[k - 1])
+
+    def start(self, index, box):
+        """
+        Finds the closest layer below an individual.
+
+        Args:
+            index (int): Index of the individual.
+            box (tuple): Region (left, upper, right, lower) of interest.
+
+        Returns:
+            tuple: Index of the first individual not drawn in the layer and the layer pixels inside the region.
+        """
+        layer = index // self.stride
+        return layer * self.stride, get_region(self.layers[layer], box)
+
+    def update(self, individuals, bounding_boxes, index, box, slot=None):
+        """
+        Redraws the layers above a changed individual inside the region it modified.
+
+        Args:
+            individuals (np.array): Array of individuals.
+            bounding_boxes (np.array): Region covered by each individual.
+            index (int): Index of the individual changed.
+            box (tuple): Region (left, upper, right, lower) modified by the change.
+            slot (int): New index of the individual, if it moved.
+        """
+        low, high = (index, index) if slot is None else (min(index, slot), max(index, slot))
+        for k in range(low // self.stride + 1, len(self.layers)):
+            first, last = (k - 1) * self.stride, k * self.stride
+            # Layers between the old and new index hold a different set of individuals
+            region = box if last > high else (0, 0) + tuple(self.renderer.size)
+            visible = overlaps(bounding_boxes[first:last], region)
+            background = get_region(self.layers[k - 1], region)
+            if visible.any():
+                get_region(self.layers[k], region)[:] = self.renderer.render(
+                    individuals[first:last][visible], region, background)
+            else:
+                get_region(self.layers[k], region)[:] = background
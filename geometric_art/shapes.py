@@ -2,72 +2,241 @@ from abc import ABC, abstractmethod
 
 import numpy as np
 
+from .utils import get_areas, move, union_box
+
 
 class ShapePopulation(ABC):
     """ Population of shapes. """
-    @abstractmethod
-    def _create(self):
-        """ Creates the initial population. """
-        pass
-
-    @abstractmethod
-    def change(self):
-        """ Changes one individual in the population. """
-        pass
-
+    # Number of random changes drawn at once
+    batch_size = 65536
+    # Gaussian steps adapt after this many proposals to keep this fraction accepted
+    step_interval = 100
+    target_success_rate = 0.2
+    step_factor = 1.2
+    # Steps are fractions of the range of each position, starting above the smallest one
+    initial_step_fraction = 1 / 8
+    min_step_fraction = 1 / 16
 
-class PolygonPopulation(ShapePopulation):
-    """ Population formed by polygons with different side lengths. """
-    def __init__(self, num_individuals, size, num_sides):
+    def __init__(self, num_individuals, size, geometry_bounds, rng=None, opaque=False, sort=False, gaussian=False):
         """
-        Initializes the variables for the population of polygons.
+        Initializes the variables shared by every population.
 
         Args:
             num_individuals (int): Fixed number of individuals in the population.
             size (tuple): Target image dimensions.
-            num_sides (int): Number of sides of the polygons.
+            geometry_bounds (list): Exclusive upper bound of each position describing the shape.
+            rng (np.random.Generator): Random number generator. Defaults to a new unseeded one.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
+            sort (bool): Whether to keep larger individuals below smaller ones.
+            gaussian (bool): Whether to perturb the parameters with adaptive Gaussian steps instead of resampling them.
         """
         self.num_individuals = num_individuals
         self.size = size
-        self.num_sides = num_sides
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.num_channels = 3 if opaque else 4
+        self.sort = sort
+        self.gaussian = gaussian
+        # Exclusive upper bound of the values of each position
+        self.upper_bounds = np.array(list(geometry_bounds) + [256] * self.num_channels)
+        self._changes = []
+        self._next_change = 0
+        self._init_steps()
         self.individuals = self._create()
+        self.bounding_boxes = self._compute_bounding_boxes()
+        if sort:
+            self._sort()
 
     def _create(self):
         """
-        Creates the initial population of polygons.
+        Creates the initial population, drawing every position below its upper bound in a single call.
 
         Returns:
             individuals (np.array): Array of individuals.
         """
-        individuals = np.zeros((self.num_individuals, 2 * self.num_sides + 4))
-        individuals[:, ::2] = np.random.randint(self.size[0], size=individuals[:, ::2].shape)
-        individuals[:, 1::2] = np.random.randint(self.size[1], size=individuals[:, 1::2].shape)
-        individuals[:, 2 * self.num_sides:] = np.random.randint(256, size=individuals[:, 2 * self.num_sides:].shape)
-        return individuals
+        return self.rng.integers(self.upper_bounds, size=(self.num_individuals, len(self.upper_bounds)), dtype=np.int16)
 
-    def change(self):
+    def _draw_change(self):
         """
-        Changes one individual in one position.
+        Takes the next random change from a batch drawn in advance.
+
+        With Gaussian steps, the new value is the current one perturbed by a normal step of the adapted size,
+        relative to the range of the position.
 
         Returns:
-            new_individuals: Population with an individual changed.
-        """
-        new_individuals = self.individuals.copy()
-        random_individual = np.random.randint(self.individuals.shape[0])
-        random_pos = np.random.randint(self.individuals.shape[1])
-        if random_pos < 2 * self.num_sides:
-            if random_pos % 2 == 0:
-                new_individuals[random_individual][random_pos] = np.random.randint(self.size[0])
+            tuple: Individual, position and new value of the change.
+        """
+        if self._next_change == len(self._changes):
+            positions = self.rng.integers(len(self.upper_bounds), size=self.batch_size)
+            indices = self.rng.integers(self.num_individuals, size=self.batch_size)
+            if self.gaussian:
+                values = self.rng.standard_normal(self.batch_size)
+            else:
+                values = self.rng.integers(self.upper_bounds[positions])
+            self._changes = list(zip(indices.tolist(), positions.tolist(), values.tolist()))
+            self._next_change = 0
+        index, position, value = self._changes[self._next_change]
+        self._next_change += 1
+        if self.gaussian:
+            step = value * self.step_sizes[self.step_groups[position]] * int(self.upper_bounds[position])
+            value = min(max(int(self.individuals[index, position]) + round(step), 0), int(self.upper_bounds[position]) - 1)
+        return index, position, value
+
+    def _init_steps(self):
+        """ Sets the initial Gaussian step sizes, as fractions of the range, one for the geometry and another for the color. """
+        self.step_groups = (np.arange(len(self.upper_bounds)) >= len(self.upper_bounds) - self.num_channels).astype(int)
+        self.step_sizes = np.full(2, self.initial_step_fraction)
+        self._trials = np.zeros(2, dtype=int)
+        self._successes = np.zeros(2, dtype=int)
+
+    def record(self, position, accepted):
+        """
+        Adapts the Gaussian step sizes with the 1/5 success rule.
+
+        Args:
+            position (int): Position of the parameter changed.
+            accepted (bool): Whether the change was kept.
+        """
+        if not self.gaussian:
+            return
+        group = self.step_groups[position]
+        self._trials[group] += 1
+        self._successes[group] += accepted
+        if self._trials[group] == self.step_interval:
+            if self._successes[group] > self.target_success_rate * self.step_interval:
+                self.step_sizes[group] *= self.step_factor
             else:
-                new_individuals[random_individual][random_pos] = np.random.randint(self.size[1])
-        else:
-            new_individuals[random_individual][random_pos] = np.random.randint(256)
-        return new_individuals
+                self.step_sizes[group] /= self.step_factor
+            self.step_sizes[group] = min(max(self.step_sizes[group], self.min_step_fraction), 1)
+            self._trials[group] = 0
+            self._successes[group] = 0
+
+    def propose(self):
+        """
+        Proposes a random change of one individual in one position.
+
+        In a sorted population, the individual also moves to the slot that keeps larger individuals below.
+
+        Returns:
+            tuple: Index of the individual, position, new value and new index of the individual.
+        """
+        index, position, value = self._draw_change()
+        slot = index
+        if self.sort:
+            new_individual = self.individuals[index].copy()
+            new_individual[position] = value
+            area = get_areas(np.array([self.bounding_box(new_individual)]))[0]
+            areas = get_areas(self.bounding_boxes)
+            # Among the slots between larger and smaller individuals, the closest keeps ties in place
+            larger = int(np.count_nonzero(areas > area)) - int(areas[index] > area)
+            not_smaller = int(np.count_nonzero(areas >= area)) - int(areas[index] >= area)
+            slot = min(max(index, larger), not_smaller)
+        return index, position, value, slot
+
+    def apply(self, index, position, value, slot):
+        """
+        Changes one individual in one position.
+
+        Args:
+            index (int): Index of the individual.
+            position (int): Position of the parameter changed.
+            value (int): New value of the parameter.
+            slot (int): New index of the individual.
+        """
+        self.individuals[index, position] = value
+        self.bounding_boxes[index] = self.bounding_box(self.individuals[index])
+        if slot != index:
+            move(self.individuals, index, slot)
+            move(self.bounding_boxes, index, slot)
+
+    def _sort(self):
+        """ Orders the individuals from the largest to the smallest area. """
+        order = np.argsort(-get_areas(self.bounding_boxes), kind='stable')
+        self.individuals = self.individuals[order]
+        self.bounding_boxes = self.bounding_boxes[order]
+
+    def modifies_image(self, index, position, value):
+        """
+        Checks whether a change can modify the image, so that the rest are rejected without rendering.
+
+        Args:
+            index (int): Index of the individual.
+            position (int): Position of the parameter changed.
+            value (int): New value of the parameter.
+
+        Returns:
+            bool: False if the value does not change or the individual stays fully transparent.
+        """
+        if self.individuals[index, position] == value:
+            return False
+        return self.num_channels == 3 or position == len(self.upper_bounds) - 1 or self.individuals[index, -1] > 0
+
+    def change_box(self, index, position, value):
+        """
+        Computes the region of the image that a change can modify.
+
+        Args:
+            index (int): Index of the individual.
+            position (int): Position of the parameter changed.
+            value (int): New value of the parameter.
+
+        Returns:
+            tuple: Box (left, upper, right, lower) covering the individual before and after the change.
+        """
+        new_individual = self.individuals[index].copy()
+        new_individual[position] = value
+        return union_box(self.bounding_box(self.individuals[index]), self.bounding_box(new_individual))
+
+    @abstractmethod
+    def bounding_box(self, individual):
+        """ Region of the image covered by an individual. """
+        pass
+
+    def _compute_bounding_boxes(self):
+        """
+        Computes the region covered by each individual.
+
+        Returns:
+            np.array: Array of boxes (left, upper, right, lower).
+        """
+        return np.array([self.bounding_box(individual) for individual in self.individuals])
+
+
+class PolygonPopulation(ShapePopulation):
+    """ Population formed by polygons with different side lengths. """
+    def __init__(self, num_individuals, size, num_sides, rng=None, opaque=False, sort=False, gaussian=False):
+        """
+        Initializes the variables for the population of polygons.
+
+        Args:
+            num_individuals (int): Fixed number of individuals in the population.
+            size (tuple): Target image dimensions.
+            num_sides (int): Number of sides of the polygons.
+            rng (np.random.Generator): Random number generator. Defaults to a new unseeded one.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
+            sort (bool): Whether to keep larger individuals below smaller ones.
+            gaussian (bool): Whether to perturb the parameters with adaptive Gaussian steps instead of resampling them.
+        """
+        self.num_sides = num_sides
+        super().__init__(num_individuals, size, [size[0], size[1]] * num_sides, rng, opaque, sort, gaussian)
+
+    def bounding_box(self, individual):
+        """
+        Computes the smallest box containing a polygon.
+
+        Args:
+            individual (np.array): Polygon parameters.
+
+        Returns:
+            tuple: Box (left, upper, right, lower) covered by the polygon.
+        """
+        x = individual[:2 * self.num_sides:2]
+        y = individual[1:2 * self.num_sides:2]
+        return int(x.min()), int(y.min()), int(x.max()) + 1, int(y.max()) + 1
 
 
 class CirclePopulation(ShapePopulation):
     """ Population formed by circles with different radius. """
-    def __init__(self, num_individuals, size, max_radius):
+    def __init__(self, num_individuals, size, max_radius, rng=None, opaque=False, sort=False, gaussian=False):
         """
         Initializes the variables for the population of circles.
 
@@ -75,42 +244,24 @@ class CirclePopulation(ShapePopulation):
             num_individuals (int): Fixed number of individuals in the population.
             size (tuple): Target image dimensions.
             max_radius (int): Maximum radius length of a circle.
+            rng (np.random.Generator): Random number generator. Defaults to a new unseeded one.
+            opaque (bool): Whether the shapes are opaque, so their color has no transparency channel.
+            sort (bool): Whether to keep larger individuals below smaller ones.
+            gaussian (bool): Whether to perturb the parameters with adaptive Gaussian steps instead of resampling them.
         """
-        self.num_individuals = num_individuals
-        self.size = size
         self.max_radius = max_radius
-        self.individuals = self._create()
+        super().__init__(num_individuals, size, [size[0], size[1], max_radius], rng, opaque, sort, gaussian)
 
-    def _create(self):
+    def bounding_box(self, individual):
         """
-        Creates the initial population of polygons.
+        Computes the smallest box containing a circle, clipped to the image.
 
-        Returns:
-            individuals (np.array): Array of individuals.
-        """
-        individuals = np.zeros((self.num_individuals, 7))
-        individuals[:, 0] = np.random.randint(self.size[0], size=individuals[:, 0].shape)
-        individuals[:, 1] = np.random.randint(self.size[1], size=individuals[:, 1].shape)
-        individuals[:, 2] = np.random.randint(self.max_radius, size=individuals[:, 2].shape)
-        individuals[:, 3:7] = np.random.randint(256, size=individuals[:, 3:7].shape)
-        return individuals
-
-    def change(self):
-        """
-        Changes one individual in one position.
+        Args:
+            individual (np.array): Circle parameters.
 
         Returns:
-            new_individuals: Population with an individual changed.
-        """
-        new_individuals = self.individuals.copy()
-        random_individual = np.random.randint(self.individuals.shape[0])
-        random_pos = np.random.randint(self.individuals.shape[1])
-        if random_pos == 0:
-            new_individuals[random_individual][random_pos] = np.random.randint(self.size[0])
-        elif random_pos == 1:
-            new_individuals[random_individual][random_pos] = np.random.randint(self.size[1])
-        elif random_pos == 2:
-            new_individuals[random_individual][random_pos] = np.random.randint(self.max_radius)
-        else:
-            new_individuals[random_individual][random_pos] = np.random.randint(256)
-        return new_individuals
+            tuple: Box (left, upper, right, lower) covered by the circle.
+        """
+        x, y, radius = individual[:3].tolist()
+        return (max(x - radius, 0), max(y - radius, 0),
+                min(x + radius + 1, self.size[0]), min(y + radius + 1, self.size[1]))